@@ -1,25 +1,36 @@
 import argparse
+import codecs
+import io
+import itertools
 import logging
 import mimetypes
+import os
+import random
 import re
+import shelve
 import sys
 import tempfile
-from concurrent.futures.thread import ThreadPoolExecutor
+import threading
+from concurrent.futures import FIRST_COMPLETED, FIRST_EXCEPTION, Future, ThreadPoolExecutor, wait
 from pprint import pformat
-from typing import Dict, List, Union, TypeVar, Optional
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 
 import asana
 import keyring
+import orjson
 import requests
 from binaryornot import check
 from jinja2 import Template
+from requests.adapters import HTTPAdapter
+from urllib3.fields import RequestField
+from urllib3.filepost import choose_boundary
+from urllib3.util.retry import Retry
 
 from clubhouse import ClubhouseClient, ClubhouseFile, ClubhouseComment, ClubhouseTask, \
-    ClubhouseStory, ClubhouseLabel, ClubhouseUser
+    ClubhouseStory, ClubhouseLabel, ClubhouseUser, ENDPOINT_HOST, ENDPOINT_PATH
 
 logger = logging.getLogger('importer')
 
-T = TypeVar('T')
 AsanaTask = Dict
 AsanaUser = Dict
 description_template = Template("""
@@ -36,6 +47,90 @@ resource_subtype == 'comment_edited' %} (Edited){% endif %}
 {{ text|trim }}
 """)
 
+# Every task field the import reads, so that task and subtask listings return complete
+# records and no task has to be fetched on its own.
+task_fields = ','.join([
+    'name', 'notes', 'resource_subtype', 'completed', 'completed_at', 'created_at',
+    'modified_at', 'due_on', 'assignee.name', 'followers.name', 'tags.name', 'projects.name',
+    'custom_fields.name', 'custom_fields.enum_value.name', 'memberships.project.name',
+    'memberships.section.name', 'num_subtasks',
+])
+
+mention_pattern = re.compile(r'https://app\.asana\.com/0/(\d+)/list')
+
+asana_host = 'https://app.asana.com'
+retry_status_codes = (429, 500, 502, 503, 504)
+post_retry_status_codes = (429, 503)
+backoff_jitter = 0.5
+download_chunk_size = 64 * 1024
+sniff_size = 1024
+unicode_boms = (codecs.BOM_UTF32_LE, codecs.BOM_UTF32_BE, codecs.BOM_UTF16_LE,
+                codecs.BOM_UTF16_BE)
+# (connect, read) seconds, so a stalled download cannot pin a worker forever.
+download_timeout = (10, 60)
+resume_cache_path = 'migration.cache'
+batch_snapshot_path = 'project-{project_id}.jsonl'
+
+
+class JitteredRetry(Retry):
+    # Adds jitter to every backoff, the first retry included, so throttled workers do
+    # not retry in lockstep, and retries POSTs, which are not idempotent, only when the
+    # API says the request was not processed.
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method.upper() == 'POST':
+            return status_code in post_retry_status_codes
+        return super().is_retry(method, status_code, has_retry_after)
+
+    def get_backoff_time(self):
+        return super().get_backoff_time() + random.uniform(0, backoff_jitter)
+
+
+class SpooledBody(tempfile.SpooledTemporaryFile):
+    # requests sizes a file body through fileno() unless it has a len, and fileno() moves
+    # a spooled file to disk. The length is reported from the current contents instead.
+
+    @property
+    def len(self):
+        position = self.tell()
+        self.seek(0, io.SEEK_END)
+        length = self.tell()
+        self.seek(position)
+        return length
+
+
+class PooledClubhouseClient(ClubhouseClient):
+    # Shares one keep-alive pool between the import workers and caps the number of
+    # connections opened to the API. Throttled or failing requests are retried with an
+    # exponential backoff, honoring Retry-After, see JitteredRetry.
+
+    def __init__(self, api_key, max_connections=12, ignored_status_codes=None):
+        super().__init__(api_key, ignored_status_codes)
+        self.session = requests.Session()
+        self.session.mount(ENDPOINT_HOST, HTTPAdapter(pool_maxsize=max_connections,
+                                                      pool_block=True,
+                                                      max_retries=get_retry()))
+
+    def _request(self, method, *segments, **kwargs):
+        if not segments[0].startswith(ENDPOINT_PATH):
+            segments = [ENDPOINT_PATH, *segments]
+
+        url = ENDPOINT_HOST + '/' + '/'.join(str(s).strip('/') for s in segments)
+        # requests appends these to any query string already in the url, e.g. the one in
+        # the 'next' link of a search.
+        kwargs['params'] = {'token': self.api_key, **kwargs.get('params', {})}
+        if 'json' in kwargs:
+            kwargs['data'] = orjson.dumps(kwargs.pop('json'))
+            kwargs['headers'] = {'Content-Type': 'application/json', **kwargs.get('headers', {})}
+
+        response = self.session.request(method, url, **kwargs)
+        if response.status_code > 299 and response.status_code not in self.ignored_status_codes:
+            logger.error("Status code: %s, Content: %s", response.status_code, response.text)
+            response.raise_for_status()
+        if response.status_code == 204:
+            return {}
+        return orjson.loads(response.content)
+
 
 class Importer(object):
     move_message = 'The task moved to '
@@ -45,51 +140,65 @@ class Importer(object):
     mention_id_prefix_length = 8
 
     def __init__(self, args):
+        mimetypes.init()
         self.ignore_email_domains = args.ignore_email_account_domain
+        self.workers = args.workers
+        # Runs the independent Asana and Clubhouse calls of a task in parallel. Jobs
+        # submitted to it never submit further jobs, so it cannot starve itself.
+        self.fetcher = ThreadPoolExecutor(max_workers=self.workers)
         asana.Client.DEFAULT_OPTIONS['page_size'] = 100
         self.asana = asana.Client.access_token(
             args.asana_api_key or get_secret_from_keyring('asana'))
+        # The SDK session keeps 10 connections by default, fewer than the threads using it.
+        self.asana.session.mount(asana_host, HTTPAdapter(pool_maxsize=2 * self.workers))
+
+        # Attachment downloads, kept alive across files and retried like API calls.
+        self.http = requests.Session()
+        self.http.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=self.workers,
+                                                max_retries=get_retry()))
 
         self.asana_skip_moved_tag = args.asana_skip_moved_tag
         self.asana_project_id = args.asana_project_id
-        self.asana_moved_tag_id = args.asana_moved_tag_id
+        self.asana_url_prefix = f"https://app.asana.com/0/{self.asana_project_id}"
+        self.asana_moved_tag_id = int(args.asana_moved_tag_id) if args.asana_moved_tag_id else None
 
-        self.clubhouse = ClubhouseClient(
-            args.clubhouse_api_key or get_secret_from_keyring('clubhouse'))
+        self.clubhouse = PooledClubhouseClient(
+            args.clubhouse_api_key or get_secret_from_keyring('clubhouse'),
+            max_connections=2 * self.workers)
 
         self.clubhouse_project_id = args.clubhouse_project_id
         self.clubhouse_complete_workflow_id = args.clubhouse_complete_workflow_id
 
         self.commit = args.commit
+        self.batch = args.batch
+        # Task id to story url of the tasks imported by previous runs, see --resume.
+        self.migrated = shelve.open(resume_cache_path) if args.resume else None
+        self.migrated_lock = threading.Lock()
         asana_users = self.get_asana_users()
         clubhouse_members = self.clubhouse.get('members')
-        self.user_mapping = self.build_asana_to_clubhouse_user_mapping(
+        self.user_mapping, self.user_mention_mapping = self.build_user_mappings(
             asana_users, clubhouse_members)
-        self.user_mention_mapping = self.build_asana_mention_to_clubhouse(
-            asana_users, clubhouse_members)
-        self.workers = args.workers
+        self.clubhouse_user_ids: Dict[str, Optional[str]] = {}
+        self.clubhouse_user_ids_lock = threading.Lock()
 
     def parse_email(self, email):
         if self.ignore_email_domains:
             return email.split('@')[0].strip()
         return email.strip()
 
-    def build_asana_mention_to_clubhouse(self, asana_users, clubhouse_members):
+    def build_user_mappings(self, asana_users, clubhouse_members) -> Tuple[
+        Dict[str, ClubhouseUser], Dict[str, Dict]]:
         clubhouse_members_by_email = {
             self.parse_email(u['profile']['email_address']): u for u in clubhouse_members}
-        return {
-            str(user['id'])[0:self.mention_id_prefix_length]:
-                {'asana': user, 'clubhouse':
-                    clubhouse_members_by_email.get(self.parse_email(user['email']))}
-            for user in asana_users}
-
-    def build_asana_to_clubhouse_user_mapping(self, asana_users, clubhouse_members) -> Dict[
-        str, str]:
-        asana_email_to_user_ids = {
-            self.parse_email(user['email']): user['id'] for user in asana_users}
-        return {
-            asana_email_to_user_ids.get(self.parse_email(user['profile']['email_address'])): user
-            for user in clubhouse_members}
+        user_mapping = {}
+        user_mention_mapping = {}
+        for user in asana_users:
+            clubhouse_member = clubhouse_members_by_email.get(self.parse_email(user['email']))
+            if clubhouse_member:
+                user_mapping[user['id']] = clubhouse_member
+            user_mention_mapping[str(user['id'])[0:self.mention_id_prefix_length]] = {
+                'asana': user, 'clubhouse': clubhouse_member}
+        return user_mapping, user_mention_mapping
 
     def import_project(self):
         if self.commit:
@@ -98,97 +207,204 @@ class Importer(object):
             logger.info(
                 'Preview mode enabled. Stories will be NOT created and Tasks will NOT modified.')
 
-        executor = ThreadPoolExecutor(max_workers=self.workers)
-        for task in self.asana.tasks.find_by_project(self.asana_project_id):
-            executor.submit(self.import_task, task)
+        try:
+            self._import_project()
+        finally:
+            if self.migrated is not None:
+                self.migrated.close()
+
+    def _import_project(self):
+        # Only a window of tasks is queued ahead of the workers, so a large project is
+        # not held in memory all at once and failures stop the listing early.
+        with self.fetcher, ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = set()
+            skipped = 0
+            for task in self.get_project_tasks():
+                if not self.is_importable(task):
+                    skipped += 1
+                    continue
+                pending.add(executor.submit(self.import_task, task))
+                if len(pending) >= 2 * self.workers:
+                    pending = self.wait_for_tasks(pending, FIRST_COMPLETED)
+            while pending:
+                pending = self.wait_for_tasks(pending, FIRST_EXCEPTION)
+        logger.info("Skipped %s tasks.", skipped)
+
+    def get_project_tasks(self) -> Iterator[AsanaTask]:
+        # The listing carries every field the import uses, sparing a fetch per task.
+        options = {'opt_fields': task_fields}
+        if not self.batch:
+            return self.asana.tasks.find_by_project(self.asana_project_id, options)
+
+        # Taken again on every run, so the tasks, their tags included, are never older
+        # than the run importing them.
+        snapshot_path = batch_snapshot_path.format(project_id=self.asana_project_id)
+        logger.info("Saving the tasks of project %s to %s ...",
+                    self.asana_project_id, snapshot_path)
+        with open(snapshot_path + '.part', 'wb') as fp:
+            for task in self.asana.tasks.find_by_project(self.asana_project_id, options):
+                fp.write(orjson.dumps(task) + b'\n')
+        os.replace(snapshot_path + '.part', snapshot_path)
+        logger.info("Reading the tasks from %s.", snapshot_path)
+        return read_json_lines(snapshot_path)
+
+    @staticmethod
+    def wait_for_tasks(pending: Set[Future], return_when: str) -> Set[Future]:
+        done, pending = wait(pending, return_when=return_when)
+        for future in done:
+            if future.exception():
+                logger.error("Failure. Stopping!", exc_info=future.exception())
+                for task in pending:
+                    task.cancel()
+                sys.exit(255)
+        return pending
 
     def get_asana_users(self):
         workspaces_id = self.asana.users.me()['workspaces'][0]['id']
         return list(self.asana.users.find_by_workspace(workspaces_id, {"opt_fields": 'email'}))
 
-    def import_task(self, thin_task: AsanaTask):
-        try:
-            task = self.asana.tasks.find_by_id(thin_task['id'])
-            if not task['name'].strip():
-                logger.info("Skipping task with no name.")
-                return
-            if task['resource_subtype'] == 'section':
-                logger.info("Skipping section.")
-                return
-            for tag in task['tags']:
-                moved_tag = int(self.asana_moved_tag_id)
-                if tag['id'] == moved_tag:
-                    message = "Task {id}: '{name}' already migrated " \
-                              "because it is tagged with '{moved_tag}'"
-                    logger.info(message.format(moved_tag=moved_tag, **task))
-                    return
-
-            subtasks = flatten(self.get_subtasks(task))
-            files = self.import_files(task, subtasks)
-            story = self.create_story(task, subtasks, files)
-            if story:
-                logger.info(f"Story created at: {story['app_url']}")
-            self.update_asana_task(task, story)
-        except:
-            logger.exception("Failure. Stopping!")
-            exit(255)
+    def is_importable(self, task: AsanaTask) -> bool:
+        if self.is_migrated(task):
+            logger.info("Task %s: '%s' already migrated according to %s",
+                        task['id'], task['name'], resume_cache_path)
+            return False
+        if not task['name'].strip():
+            logger.info("Skipping task with no name.")
+            return False
+        if task['resource_subtype'] == 'section':
+            logger.info("Skipping section.")
+            return False
+        if self.asana_moved_tag_id and any(
+                tag['id'] == self.asana_moved_tag_id for tag in task['tags']):
+            logger.info("Task %s: '%s' already migrated because it is tagged with '%s'",
+                        task['id'], task['name'], self.asana_moved_tag_id)
+            return False
+        return True
+
+    def import_task(self, task: AsanaTask):
+        # The task's stories load while the subtasks are walked, and the subtasks'
+        # stories while the attachments are transferred.
+        stories = [self.fetcher.submit(self.get_stories, task)]
+        subtasks = self.get_subtasks(task)
+        stories.extend(self.fetcher.submit(self.get_stories, subtask) for subtask in subtasks)
+        files = self.import_files(task, subtasks)
+        story = self.create_story(task, subtasks, files, [s.result() for s in stories])
+        if story:
+            logger.info("Story created at: %s", story['app_url'])
+        # Recorded before the Asana writes, so a failure there cannot lead to a duplicate.
+        self.remember_migrated(task, story)
+        self.update_asana_task(task, story)
+
+    def is_migrated(self, task: AsanaTask) -> bool:
+        if self.migrated is None:
+            return False
+        with self.migrated_lock:
+            return str(task['id']) in self.migrated
+
+    def remember_migrated(self, task: AsanaTask, story: Optional[ClubhouseStory]) -> None:
+        if self.migrated is None or not story:
+            return
+        with self.migrated_lock:
+            self.migrated[str(task['id'])] = story['app_url']
+            self.migrated.sync()
 
     def import_files(self, task: AsanaTask, subtasks: List[AsanaTask]) -> List[ClubhouseFile]:
-        return flatten([self._import_files(t) for t in [task] + subtasks])
-
-    def _import_files(self, task):
         if not self.commit:
             logger.debug("Skipping fetching and uploading files ...")
             return [{'id': "fake-guid"}]
 
-        options = {'opt_fields': 'name,download_url'}
-        created_files: List[ClubhouseFile] = []
-        for attachment in self.asana.attachments.find_by_task(task['id'], options):
-            filename = attachment['name'].strip()
-            with tempfile.SpooledTemporaryFile(suffix=filename, max_size=10 * 1024 * 1024) as fp:
-                logger.info(f"Fetching {filename} for {task['id']} ...")
-                url = attachment['download_url']
-                fp.write(requests.get(url).content)
-                fp.seek(0)
-                logger.info(f"Uploading {filename} ...")
-                content_type, _ = mimetypes.guess_type(filename)
-                text_plain = 'text/plain'
-                if not content_type or content_type == text_plain:
-                    if check.is_binary_string(fp.read(1024)):
-                        content_type = 'application/octet-stream'
-                    else:
-                        content_type = text_plain
-
-                fp.seek(0)
-                payload = {'file': (filename, fp, content_type, {'content-type': content_type})}
-                file = self.clubhouse.post("files", files=payload)
-                created_files.append(file)
-
-        return created_files
-
-    def get_subtasks(self, thin_task: AsanaTask, level: int = 0) -> List[Union[AsanaTask, List]]:
-        subtasks = [self.asana.tasks.find_by_id(thin_task['id']) for thin_task in
-                    self.asana.tasks.subtasks(thin_task['id'])]
-        if not subtasks:
-            return []
-        else:
-            for task in subtasks:
-                # Will be used to makes nice markdown bullet points if subtask of a subtask
-                task['level'] = level
-            return subtasks + [self.get_subtasks(subtask, level + 1) for subtask in subtasks]
+        attachments = list(itertools.chain.from_iterable(
+            self.fetcher.map(self.get_attachments, itertools.chain([task], subtasks))))
+        return list(self.fetcher.map(self.import_file, attachments))
+
+    def get_attachments(self, task: AsanaTask) -> List[Dict]:
+        options = {'opt_fields': 'name,download_url,parent'}
+        return list(self.asana.attachments.find_by_task(task['id'], options))
+
+    def import_file(self, attachment: Dict) -> ClubhouseFile:
+        filename = attachment['name'].strip()
+        boundary = choose_boundary()
+        with SpooledBody(suffix=filename, max_size=10 * 1024 * 1024) as fp:
+            logger.info("Fetching %s for %s ...", filename, attachment['parent']['id'])
+            url = attachment['download_url']
+            # The multipart body is written around the file as it downloads, so the upload
+            # streams it back instead of requests encoding another copy in memory.
+            with self.http.get(url, stream=True, timeout=download_timeout) as response:
+                response.raise_for_status()
+                chunks = response.iter_content(chunk_size=download_chunk_size)
+                # The part headers come first and their content type is sniffed from the
+                # start of the file.
+                head = b''
+                for chunk in chunks:
+                    head += chunk
+                    if len(head) >= sniff_size:
+                        break
+                content_type = self.get_content_type(filename, head[:sniff_size])
+                fp.write(multipart_file_header(boundary, filename, content_type))
+                fp.write(head)
+                for chunk in chunks:
+                    fp.write(chunk)
+                fp.write(f"\r\n--{boundary}--\r\n".encode())
+            fp.seek(0)
+            logger.info("Uploading %s ...", filename)
+            headers = {'Content-Type': f"multipart/form-data; boundary={boundary}"}
+            return self.clubhouse.post("files", data=fp, headers=headers)
 
-    def build_comments(self, task: AsanaTask, subtasks: List[AsanaTask]) -> List[ClubhouseComment]:
-        return flatten([self._build_comments(subtask) for subtask in [task] + subtasks])
-
-    def _build_comments(self, task: AsanaTask) -> List[ClubhouseComment]:
-        return [self.build_comment(task, comment)
-                for comment in self.asana.stories.find_by_task(task['id'])
+    @staticmethod
+    def get_content_type(filename: str, head: bytes) -> str:
+        content_type, _ = mimetypes.guess_type(filename)
+        text_plain = 'text/plain'
+        if not content_type or content_type == text_plain:
+            # Like git, take a NUL byte as binary, which a C-level scan finds without
+            # running binaryornot's chardet detection. UTF-16/32 text has NULs too.
+            is_binary = b'\0' in head and not head.startswith(unicode_boms)
+            if is_binary or check.is_binary_string(head):
+                return 'application/octet-stream'
+            return text_plain
+        return content_type
+
+    def get_subtasks(self, task: AsanaTask) -> List[AsanaTask]:
+        # Walks the subtask tree breadth first, listing each level in parallel.
+        subtasks: List[AsanaTask] = []
+        parents, level = [task], 0
+        while parents:
+            # Leaves are known from num_subtasks and not listed.
+            parents = [parent for parent in parents if parent.get('num_subtasks', 1)]
+            children = [child
+                        for children in self.fetcher.map(self.list_subtasks, parents)
+                        for child in children]
+            for child in children:
+                # Will be used to makes nice markdown bullet points if subtask of a subtask
+                child['level'] = level
+            subtasks.extend(children)
+            parents, level = children, level + 1
+        return subtasks
+
+    def list_subtasks(self, task: AsanaTask) -> List[AsanaTask]:
+        return list(self.asana.tasks.subtasks(task['id'], {'opt_fields': task_fields}))
+
+    def get_stories(self, task: AsanaTask) -> List[Dict]:
+        # Only what the comments and the requestor are built from.
+        options = {'opt_fields': 'type,text,created_at,created_by.name,resource_subtype'}
+        return list(self.asana.stories.find_by_task(task['id'], options))
+
+    def build_comments(self, task: AsanaTask, subtasks: List[AsanaTask],
+                       stories: List[List[Dict]]) -> List[ClubhouseComment]:
+        return list(itertools.chain.from_iterable(
+            self._build_comments(t, t_stories)
+            for t, t_stories in zip(itertools.chain([task], subtasks), stories)))
+
+    def _build_comments(self, task: AsanaTask, stories: List[Dict]) -> List[ClubhouseComment]:
+        url = self.get_asana_url(task)
+        return [self.build_comment(task, comment, url)
+                for comment in stories
                 if comment['type'] != 'system' and not comment['text'].startswith(
                 self.move_message)]
 
-    def get_requestor(self, task):
-        for story in self.asana.stories.find_by_task(task['id']):
-            return self.convert_to_clubhouse_user_id(story['created_by'])
+    def get_requestor(self, stories: List[Dict]) -> Optional[str]:
+        if not stories:
+            return None
+        return self.convert_to_clubhouse_user_id(stories[0]['created_by'])
 
     def _mention_replacer(self, match):
         match = match.group()
@@ -204,17 +420,18 @@ class Importer(object):
         mention_name = user['clubhouse']['profile']['mention_name']
         return f"[@{ mention_name }](clubhouse:\/\/members\/{ matched_id})"
 
-    def build_comment(self, task: AsanaTask, comment: Dict) -> ClubhouseComment:
+    def build_comment(self, task: AsanaTask, comment: Dict, url: str) -> ClubhouseComment:
         user_id = self.convert_to_clubhouse_user_id(comment['created_by'])
-        text = comment_template.render(user_found=(user_id is not None),
+        text = comment_template.render(comment,
+                                       user_found=(user_id is not None),
                                        task=task,
-                                       url=self.get_asana_url(task), **comment).strip()
-        text = re.sub(r'https://app\.asana\.com/0/(\d+)/list', self._mention_replacer, text)
+                                       url=url).strip()
+        text = mention_pattern.sub(self._mention_replacer, text)
         return cleanup_dict(
             {
                 'author_id': user_id,
                 'created_at': comment['created_at'],
-                'external_id': self.get_asana_url(task),
+                'external_id': url,
                 'text': text
             }
         )
@@ -227,7 +444,7 @@ class Importer(object):
             "description": f"{prefix}[{subtask['name']}]({url})\n{subtask['notes']}",
             'complete': subtask['completed'],
             'created_at': subtask['created_at'],
-            'external_id': self.get_asana_url(subtask),
+            'external_id': url,
             'owner_ids': self.get_owners(subtask)
         })
 
@@ -257,25 +474,26 @@ class Importer(object):
                 }
         return {}
 
-    def create_story(self, task: AsanaTask, subtasks: List[AsanaTask], files) -> Optional[
-        ClubhouseStory]:
+    def create_story(self, task: AsanaTask, subtasks: List[AsanaTask], files,
+                     stories: List[List[Dict]]) -> Optional[ClubhouseStory]:
+        # stories holds the stories of the task, then those of each subtask.
         labels = [{'name': 'From Asana'}]
         labels.extend([{'name': label['name']} for label in task['tags']])
         labels.extend([self.build_label_from_projects(project) for project in task['projects']])
         labels.extend(self.build_labels_from_custom_fields(task))
         labels.append(self.get_section(task))
-        tasks = [cleanup_dict(self.build_task(subtask)) for subtask in subtasks]
+        tasks = [self.build_task(subtask) for subtask in subtasks]
         workflow_id = self.clubhouse_complete_workflow_id if task['completed'] else None
         task_url = self.get_asana_url(task)
         completed_at = task['completed_at']
         story = cleanup_dict({
             'archived': True if completed_at else False,
-            'comments': self.build_comments(task, subtasks),
+            'comments': self.build_comments(task, subtasks, stories),
             'completed_at_override': completed_at,
             'created_at': task['created_at'],
             'deadline': self.get_deadline(task),
             'story_type': self.get_story_type(task),
-            'description': description_template.render(**task).strip(),
+            'description': description_template.render(task).strip(),
             'external_id': task_url,
             'labels': [label for label in labels if label],
             'file_ids': [file['id'] for file in files],
@@ -283,13 +501,14 @@ class Importer(object):
             'name': task['name'].strip(),
             'owner_ids': self.get_owners(task),
             'project_id': self.clubhouse_project_id,
-            'requested_by_id': self.get_requestor(task),
+            'requested_by_id': self.get_requestor(stories[0]),
             'tasks': tasks,
             'updated_at': task['modified_at'],
             'workflow_state_id': workflow_id
         })
 
-        logger.debug(pformat(story))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(pformat(story))
 
         if not self.commit:
             logger.debug("Skipping creating story ...")
@@ -334,18 +553,26 @@ class Importer(object):
     def convert_to_clubhouse_user_id(self, user: AsanaUser) -> Optional[str]:
         if not user:
             return None
-        user: ClubhouseUser = self.user_mapping.get(user['id'])
-        if not user:
-            email = user.get('email', 'unknown') if user else 'unknown'
-            logger.warning(f"The asana user '{email}' does not exist in clubhouse.")
+        # Owners, followers and comment authors are mostly the same handful of people. The
+        # lock makes each of them resolved, and warned about, once.
+        with self.clubhouse_user_ids_lock:
+            if user['id'] not in self.clubhouse_user_ids:
+                self.clubhouse_user_ids[user['id']] = self._convert_to_clubhouse_user_id(user)
+            return self.clubhouse_user_ids[user['id']]
+
+    def _convert_to_clubhouse_user_id(self, user: AsanaUser) -> Optional[str]:
+        clubhouse_user: ClubhouseUser = self.user_mapping.get(user['id'])
+        if not clubhouse_user:
+            email = user.get('email') or user.get('name') or 'unknown'
+            logger.warning("The asana user '%s' does not exist in clubhouse.", email)
             return None
-        return user.get('id')
+        return clubhouse_user.get('id')
 
     def get_follower_ids(self, task: AsanaTask) -> List[str]:
         return cleanup_list([self.convert_to_clubhouse_user_id(user) for user in task['followers']])
 
     def get_asana_url(self, task: AsanaTask) -> str:
-        return f"https://app.asana.com/0/{self.asana_project_id}/{task['id']}/f"
+        return f"{self.asana_url_prefix}/{task['id']}/f"
 
     # Include when ready
     def update_asana_task(self, task: AsanaTask, story: ClubhouseStory) -> None:
@@ -359,29 +586,35 @@ class Importer(object):
         self.asana.tasks.add_tag(task['id'], {'tag': self.asana_moved_tag_id})
 
 
+def get_retry() -> Retry:
+    return JitteredRetry(total=6, backoff_factor=0.5, status_forcelist=retry_status_codes,
+                         raise_on_status=False)
+
+
+def multipart_file_header(boundary: str, filename: str, content_type: str) -> bytes:
+    field = RequestField(name='file', data=b'', filename=filename)
+    field.make_multipart(content_type=content_type)
+    return f"--{boundary}\r\n{field.render_headers()}".encode()
+
+
 def cleanup_dict(kv: Dict) -> Dict:
-    return {k: v for k, v in kv.items() if v}
+    for k in [k for k, v in kv.items() if not v]:
+        del kv[k]
+    return kv
 
 
 def cleanup_list(l: List) -> List:
     return [i for i in l if i]
 
 
-def get_secret_from_keyring(service: str) -> str:
-    return keyring.get_password('external', service)
-
-
-def flatten(container: List[Union[List, T]]) -> List[T]:
-    return list(_flatten(container))
+def read_json_lines(file_path: str) -> Iterator[Dict]:
+    with open(file_path, 'rb') as fp:
+        for line in fp:
+            yield orjson.loads(line)
 
 
-def _flatten(container: List[Union[T, List]]) -> List[T]:
-    for i in container:
-        if isinstance(i, (list, tuple)):
-            for j in _flatten(i):
-                yield j
-        else:
-            yield i
+def get_secret_from_keyring(service: str) -> str:
+    return keyring.get_password('external', service)
 
 
 def _setup_logging(verbose):
@@ -415,8 +648,19 @@ if __name__ == '__main__':
                         default=False,
                         help='Changes things. Be careful!',
                         action='store_true')
+    parser.add_argument('--batch',
+                        default=False,
+                        help=f"List the whole project into '{batch_snapshot_path}' before "
+                             "importing from that file.",
+                        action='store_true')
+    parser.add_argument('--resume',
+                        default=False,
+                        help=f"Skip the tasks imported by previous runs, as recorded in "
+                             f"'{resume_cache_path}'.",
+                        action='store_true')
     parser.add_argument('--workers',
-                        default=12)
+                        default=12,
+                        type=int)
     parser.add_argument('-v', '---verbose',
                         default=False,
                         action='store_true')